@@ -13,10 +13,10 @@ import argparse
 from datetime import datetime
 import time
 
-# 配置日志
+# 配置日志，默认INFO级别；设置环境变量WSUB_DEBUG时启用DEBUG
 sys.stdout.reconfigure(encoding='utf-8')
 logging.basicConfig(
-    level=logging.INFO,
+    level=logging.DEBUG if os.environ.get('WSUB_DEBUG') else logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
         logging.FileHandler("W-sub.log", encoding='utf-8'),
@@ -41,11 +41,13 @@ class SubscriptionManager:
     def _ensure_output_dir(self):
         """确保输出目录存在"""
         try:
-            if not os.path.exists(self.output_dir):
-                os.makedirs(self.output_dir, exist_ok=True)
-                logger.info(f"已创建输出目录: {self.output_dir}")
+            # 直接尝试创建目录，已存在时由FileExistsError判断，省去一次exists检查
+            os.makedirs(self.output_dir)
+            logger.info("已创建输出目录: %s", self.output_dir)
+        except FileExistsError:
+            pass
         except Exception as e:
-            logger.error(f"创建输出目录失败: {str(e)}")
+            logger.error("创建输出目录失败: %s", e)
     
     def _get_output_path(self, filename):
         """获取文件的完整输出路径"""
@@ -53,14 +55,18 @@ class SubscriptionManager:
     
     def process_subscriptions(self):
         """处理订阅，包括获取、合并节点和生成文件"""
-        start_time = time.time()
+        start_time = time.perf_counter()
         
         try:
             # 创建节点处理器实例
             processor = NodeProcessor(self.config)
             
-            # 合并节点
-            nodes = processor.merge_nodes()
+            try:
+                # 合并节点
+                nodes = processor.merge_nodes()
+            finally:
+                # 节点获取完成后释放共用的连接池
+                processor.close()
             
             if not nodes:
                 logger.error("未能获取任何节点，请检查网络连接或源地址是否有效")
@@ -70,12 +76,12 @@ class SubscriptionManager:
             output_path = self._get_output_path(self.config["OUTPUT_ALL_FILE"])
             processor.generate_subscription_file(nodes, output_path)
             
-            elapsed_time = time.time() - start_time
-            logger.info(f"=== W-sub 节点订阅汇总工具运行完成 ===")
-            logger.info(f"所有节点处理完成，共生成{len(nodes)}个节点的订阅")
-            logger.info(f"总耗时: {elapsed_time:.2f} 秒")
+            elapsed_time = time.perf_counter() - start_time
+            logger.info("=== W-sub 节点订阅汇总工具运行完成 ===")
+            logger.info("所有节点处理完成，共生成%s个节点的订阅", len(nodes))
+            logger.info("总耗时: %.2f 秒", elapsed_time)
         except Exception as e:
-            logger.error(f"处理订阅时发生错误: {str(e)}")
+            logger.error("处理订阅时发生错误: %s", e)
             import traceback
             traceback.print_exc()
 
@@ -87,14 +93,13 @@ def main():
     args = parser.parse_args()
     
     # 如果启用调试模式，设置日志级别为DEBUG
+    # 处理器挂在根日志器上，各模块也通过根日志器输出，因此需调整根日志器的级别
     if args.debug:
-        for handler in logger.handlers:
-            handler.setLevel(logging.DEBUG)
-        logger.setLevel(logging.DEBUG)
+        logging.getLogger().setLevel(logging.DEBUG)
     
     logger.info("=== W-sub 节点订阅汇总工具启动 ===")
-    logger.info(f"当前时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    logger.info(f"输出目录: {args.output}")
+    logger.info("当前时间: %s", datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    logger.info("输出目录: %s", args.output)
     
     try:
         # 加载配置
@@ -109,7 +114,7 @@ def main():
     except KeyboardInterrupt:
         logger.info("程序被用户中断")
     except Exception as e:
-        logger.error(f"程序运行出错: {str(e)}")
+        logger.error("程序运行出错: %s", e)
         import traceback
         traceback.print_exc()
 
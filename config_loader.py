@@ -3,6 +3,21 @@ import os
 import re
 import logging
 
+# 可能的配置文件路径，导入时计算一次
+_CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+_CONFIG_PATHS = (
+    os.path.join(_CURRENT_DIR, "config", "config.txt"),
+    os.path.join(_CURRENT_DIR, "config.txt"),
+    "config/config.txt",
+    "config.txt"
+)
+
+# 预编译URL正则表达式
+_URL_PATTERN = re.compile(r'^https?://')
+
+# 需要按整数解析的配置项
+_INT_KEYS = frozenset({"TIMEOUT", "WORKERS", "MAX_RETRY", "MAX_BYTES"})
+
 class ConfigLoader:
     """配置加载器，从配置文件读取节点源和其他设置"""
     
@@ -14,64 +29,58 @@ class ConfigLoader:
             "TIMEOUT": 5,
             "OUTPUT_ALL_FILE": "subscription_all.txt",
             "WORKERS": 10,
-            "MAX_RETRY": 2
+            "MAX_RETRY": 2,
+            "MAX_BYTES": 8 * 1024 * 1024,
+            "CACHE_FILE": "source_cache.db"
         }
         
-        # 预编译URL正则表达式
-        url_pattern = re.compile(r'^https?://')
-        
-        # 尝试多个可能的配置文件路径
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        possible_paths = [
-            os.path.join(current_dir, "config", "config.txt"),
-            os.path.join(current_dir, "config.txt"),
-            "config/config.txt",
-            "config.txt"
-        ]
-        
         # 尝试所有可能的路径
-        for path in possible_paths:
+        for path in _CONFIG_PATHS:
             try:
                 if os.path.exists(path):
-                    logging.info(f"尝试加载配置文件: {path}")
+                    logging.info("尝试加载配置文件: %s", path)
                     with open(path, 'r', encoding='utf-8') as f:
                         config["SOURCES"] = []  # 清空源列表
+                        add_source = config["SOURCES"].append
                         
                         for line in f:
                             line = line.strip()
-                            if not line or line.startswith('#'):
+                            if not line or line[0] == '#':
                                 continue
                             
-                            # 解析配置项
-                            if '=' in line:
-                                key, value = line.split('=', 1)
-                                key, value = key.strip(), value.strip()
-                                
-                                if key == "SOURCES" and url_pattern.match(value):
-                                    config[key].append(value)
-                                elif key in config:
-                                    if key in ["TIMEOUT", "WORKERS", "MAX_RETRY"]:
-                                        try:
-                                            config[key] = int(value)
-                                        except ValueError:
-                                            logging.warning(f"配置项 {key} 值无效，使用默认值")
-                                    else:
-                                        config[key] = value
                             # 简化格式：直接识别URL
-                            elif url_pattern.match(line):
-                                config["SOURCES"].append(line)
+                            if _URL_PATTERN.match(line):
+                                add_source(line)
+                                continue
+                            
+                            # 解析配置项，partition只切分一次且不创建列表
+                            key, sep, value = line.partition('=')
+                            if not sep:
+                                continue
+                            key, value = key.strip(), value.strip()
+                            
+                            if key == "SOURCES":
+                                if _URL_PATTERN.match(value):
+                                    add_source(value)
+                            elif key in _INT_KEYS:
+                                try:
+                                    config[key] = int(value)
+                                except ValueError:
+                                    logging.warning("配置项 %s 值无效，使用默认值", key)
+                            elif key in config:
+                                config[key] = value
                     
                     # 去重节点源，避免重复请求
                     config["SOURCES"] = list(dict.fromkeys(config["SOURCES"]))
                     
-                    logging.info(f"成功加载配置文件: {path}")
+                    logging.info("成功加载配置文件: %s", path)
                     break
             except Exception as e:
-                logging.error(f"加载配置文件 {path} 失败: {str(e)}")
+                logging.error("加载配置文件 %s 失败: %s", path, e)
         
         # 检查是否有有效的节点源
         if not config["SOURCES"]:
             logging.warning("未找到有效的节点源，请在config.txt中添加节点源URL")
         
-        logging.info(f"成功加载配置，共 {len(config['SOURCES'])} 个节点源")
+        logging.info("成功加载配置，共 %s 个节点源", len(config['SOURCES']))
         return config
\ No newline at end of file
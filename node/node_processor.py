@@ -1,174 +1,284 @@
 # -*- coding: utf-8 -*-
 import re
 import base64
+import binascii
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import time
 from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
+from functools import lru_cache
+from node.source_cache import SourceCache
 
 class NodeProcessor:
     """节点处理器，整合节点获取和合并功能"""
     
+    # 支持的节点协议
+    SUPPORTED_PROTOCOLS = frozenset({
+        'vmess', 'v2ray', 'trojan', 'trojan-go', 'shadowsocks', 'shadowsocksr', 'vless',
+        'ss', 'ssr', 'hysteria', 'hysteria2', 'tuic', 'wireguard', 'naiveproxy', 'socks',
+        'http', 'https', 'clash', 'shadowsocks2', 'vmess+tls', 'vless+tls'
+    })
+    
     # 预编译正则表达式以提高效率
-    NODE_PATTERN = re.compile(r'^(vmess|v2ray|trojan|trojan-go|shadowsocks|shadowsocksr|vless|ss|ssr|hysteria|hysteria2|tuic|wireguard|naiveproxy|socks|http|https|clash|shadowsocks2|vmess\+tls|vless\+tls)://')
+    # 节点匹配正则由SUPPORTED_PROTOCOLS生成，较长的协议名优先匹配；按行匹配整条节点链接（去除首尾空白）
+    # 节点链接均为ASCII协议头，直接在原始字节上匹配，只对匹配到的节点做UTF-8解码
+    NODE_PATTERN = re.compile(
+        rb'^[ \t]*((?:' + '|'.join(map(re.escape, sorted(SUPPORTED_PROTOCOLS, key=len, reverse=True))).encode('ascii') + rb')://\S+(?:[ \t]+\S+)*)',
+        re.IGNORECASE | re.MULTILINE
+    )
     URL_PATTERN = re.compile(r'^https?://')
+    BASE64_PATTERN = re.compile(rb'[A-Za-z0-9+/]+={0,2}')
+    # Base64内容中需要去除的空白字符
+    WHITESPACE = b' \t\r\n\x0b\x0c'
     
     # 协议特定的正则表达式，用于提取更精确的节点标识
-    VMESS_PATTERN = re.compile(r'server":"([^"]+)".*?port":(\d+)')
-    VLESS_PATTERN = re.compile(r'@([^:]+):(\d+)')
-    TROJAN_PATTERN = re.compile(r'@([^:]+):(\d+)')
+    # 端口最多5位数字，过长的数字串不作为端口匹配，避免int()转换超长数字
+    VMESS_PATTERN = re.compile(rb'server":"([^"]+)".*?port":(\d{1,5})(?!\d)')
+    # vless与trojan链接的"@主机:端口"格式相同，共用一个正则
+    HOST_PORT_PATTERN = re.compile(r'@([^:]+):(\d{1,5})(?!\d)')
+    
+    # Base64填充字符，按需切片使用
+    BASE64_PADDING = '===='
+    
+    # 分块写入订阅文件时每块的字节数，取3的倍数使各块的Base64结果可直接拼接
+    WRITE_CHUNK_SIZE = 48 * 1024
+    
+    # 节点提取/解析格式版本，修改提取或解析逻辑后递增，使旧的缓存节点失效
+    CACHE_VERSION = 1
+    
+    # 所有请求共用的请求头
+    DEFAULT_HEADERS = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    }
     
     def __init__(self, config):
         self.config = config
         self.timeout = config.get("TIMEOUT", 5)
         self.max_retry = config.get("MAX_RETRY", 2)
         self.workers = min(config.get("WORKERS", 10), 20)  # 限制最大并发数，避免资源浪费
-        self._node_id_cache = set()  # 用于高效去重的节点标识缓存
-        self._protocol_stats = defaultdict(int)  # 统计各协议节点数量
+        self.max_bytes = config.get("MAX_BYTES", 8 * 1024 * 1024)  # 单个节点源的最大读取字节数
+        self._session = self._create_session()
+        self._cache = self._open_cache(config.get("CACHE_FILE"))
+    
+    def _create_session(self):
+        """创建所有节点源共用的会话，通过连接池复用TCP/TLS连接"""
+        session = requests.Session()
+        session.headers.update(self.DEFAULT_HEADERS)
+        # 重试由fetch_nodes自行控制（内容为空时也需要重试），适配器不再重复重试
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+    
+    def _open_cache(self, cache_file):
+        """打开节点源缓存，未配置或打开失败时不使用缓存"""
+        if not cache_file:
+            return None
+        
+        try:
+            return SourceCache(cache_file, self.CACHE_VERSION)
+        except Exception as e:
+            logging.warning("打开节点源缓存 %s 失败，将不使用缓存: %s", cache_file, e)
+            return None
+    
+    def close(self):
+        """关闭共用会话和节点源缓存，释放连接池"""
+        self._session.close()
+        if self._cache:
+            self._cache.close()
     
     def fetch_nodes(self, url):
         """从指定URL获取节点列表"""
         nodes = []
         retry_count = 0
         
+        # 节点源有可用的缓存节点时才发起条件请求，内容未变化则直接复用上次的节点
+        cached_nodes = self._cache.load_nodes(url) if self._cache else []
+        headers = self._cache.conditional_headers(url) if cached_nodes else None
+        
         while retry_count <= self.max_retry:
             try:
-                # 使用会话对象提高连接复用效率
-                with requests.Session() as session:
-                    session.headers.update({
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                    })
-                    logging.info(f"正在获取节点源: {url} (尝试 {retry_count + 1}/{self.max_retry + 1})")
-                    response = session.get(url, timeout=self.timeout)
+                logging.info("正在获取节点源: %s (尝试 %s/%s)", url, retry_count + 1, self.max_retry + 1)
+                # 使用共用会话，同一主机的多个源及重试均可复用连接
+                with self._session.get(url, timeout=self.timeout, stream=True, headers=headers) as response:
+                    if response.status_code == 304:
+                        if cached_nodes:
+                            nodes = cached_nodes
+                            logging.info("节点源 %s 未变化，使用缓存的 %s 个节点", url, len(nodes))
+                            break
+                        # 没有可用的缓存节点却收到304，重试时不再携带条件请求头
+                        headers = None
+                        raise requests.RequestException("收到304响应，但没有可用的缓存节点")
+                    
                     response.raise_for_status()
+                    # 流式读取响应内容，限制单个源的内存占用
+                    content, truncated = self._read_content(response, url)
+                
+                if content and not content.isspace():
+                    # 跨节点源的去重统一在merge_nodes中完成
+                    extracted_nodes = self._extract_nodes(content, truncated)
+                    if truncated:
+                        # 截断处的最后一个节点可能不完整，直接丢弃
+                        extracted_nodes = extracted_nodes[:-1]
                     
-                    # 尝试解码响应内容
-                    content = response.text.strip()
-                    if content:
-                        extracted_nodes = self._extract_nodes(content)
-                        # 对获取到的节点进行初步去重和筛选
-                        valid_nodes = self._filter_invalid_nodes(extracted_nodes)
-                        
-                        if valid_nodes:
-                            nodes = valid_nodes
-                            logging.info(f"成功从 {url} 获取 {len(nodes)} 个有效节点")
-                            break
-                        else:
-                            logging.warning(f"从 {url} 获取内容，但未能提取到有效节点")
+                    if extracted_nodes:
+                        nodes = extracted_nodes
+                        logging.info("成功从 %s 获取 %s 个有效节点", url, len(nodes))
+                        # 截断的内容不完整，不写入缓存，避免304时反复复用
+                        if self._cache and not truncated:
+                            self._cache.store(url, response.headers.get('ETag'),
+                                              response.headers.get('Last-Modified'), nodes)
+                        break
+                    elif truncated:
+                        # 重新下载得到的仍是同样截断的内容，不再重试
+                        logging.warning("从 %s 获取的内容已截断，且未能提取到有效节点", url)
+                        break
                     else:
-                        logging.warning(f"从 {url} 获取的内容为空")
+                        logging.warning("从 %s 获取内容，但未能提取到有效节点", url)
+                else:
+                    logging.warning("从 %s 获取的内容为空", url)
             except requests.RequestException as e:
-                logging.error(f"获取节点源 {url} 失败: {str(e)}")
+                logging.error("获取节点源 %s 失败: %s", url, e)
             except Exception as e:
-                logging.error(f"处理节点源 {url} 时发生未预期错误: {str(e)}")
+                logging.error("处理节点源 %s 时发生未预期错误: %s", url, e)
             
             retry_count += 1
             if retry_count <= self.max_retry:
-                logging.info(f"将在重试 {url}")
+                logging.info("将在重试 %s", url)
                 time.sleep(1)  # 添加短暂延迟避免请求过于频繁
         
         return nodes
     
-    def _extract_nodes(self, content):
-        """从内容中提取节点信息"""
-        nodes = []
+    def _read_content(self, response, url):
+        """分块读取响应内容（原始字节缓冲区），超过MAX_BYTES时截断，返回(内容, 是否截断)"""
+        buffer = bytearray()
+        for chunk in response.iter_content(chunk_size=65536):
+            buffer.extend(chunk)
+            if len(buffer) > self.max_bytes:
+                logging.warning("节点源 %s 内容超过 %s 字节，已截断", url, self.max_bytes)
+                del buffer[self.max_bytes:]
+                return buffer, True
         
+        # 直接返回缓冲区，避免再复制一份完整内容
+        return buffer, False
+    
+    def _extract_nodes(self, content, truncated=False):
+        """从原始字节内容中提取节点信息"""
         # 首先尝试解码Base64，提高节点提取效率
-        decoded_content = self._try_decode_base64(content)
+        decoded_content = self._try_decode_base64(content, truncated)
         if decoded_content:
             content = decoded_content
         
-        # 优化按行处理逻辑，避免不必要的操作
-        for line in content.split('\n'):
-            stripped_line = line.strip()
-            if stripped_line and self.NODE_PATTERN.match(stripped_line):
-                nodes.append(stripped_line)
-        
-        return nodes
+        # 对整段字节内容执行一次findall，逐行扫描交由正则引擎完成；
+        # 按出现顺序去除完全相同的节点后，只解码保留下来的节点
+        return [node.decode('utf-8', errors='ignore')
+                for node in dict.fromkeys(self.NODE_PATTERN.findall(content))]
     
-    def _try_decode_base64(self, content):
-        """尝试解码Base64内容"""
+    def _try_decode_base64(self, content, truncated=False):
+        """尝试解码Base64字节内容，返回解码后的字节；内容被截断时丢弃末尾不完整的分组"""
         try:
-            # 快速检查是否可能是Base64格式
-            if not all(c.isalnum() or c in '+/=' for c in content):
+            # 先只对开头256字节去除空白并检查字符集，明文内容无需复制整个缓冲区；
+            # 误判的明文解码后无法匹配节点链接，仍会被下方的检查排除
+            head = content[:256].translate(None, self.WHITESPACE)
+            if not self.BASE64_PATTERN.fullmatch(head, 0, 128):
                 return None
             
-            # 尝试直接解码或添加填充后解码
-            try:
-                return base64.b64decode(content).decode('utf-8')
-            except:
-                # 尝试添加填充后解码
-                missing_padding = len(content) % 4
-                if missing_padding:
-                    content += '=' * (4 - missing_padding)
-                return base64.b64decode(content).decode('utf-8')
-        except:
-            logging.debug("内容不是有效的Base64格式")
-            return None
+            # 开头像Base64时才对整段内容执行translate，兼容按行折断的Base64内容
+            cleaned = content.translate(None, self.WHITESPACE)
+            
+            if truncated:
+                # 截断处可能余下1个字符，补齐填充会导致解码失败，改为去掉不完整的分组
+                del cleaned[len(cleaned) & ~3:]
+            else:
+                # 一次性补齐填充后解码，不再多次尝试
+                cleaned += b'=' * (-len(cleaned) % 4)
+            decoded = base64.b64decode(cleaned, validate=False)
+            
+            # 解码结果开头应包含受支持协议的节点链接，否则按明文处理；
+            # 复用预编译的节点正则，一次扫描即可判断
+            if self.NODE_PATTERN.search(decoded, 0, 4096):
+                return decoded
+        except Exception:
+            pass
+        
+        logging.debug("内容不是有效的Base64格式")
+        return None
     
-    def _extract_node_identifier(self, node):
-        """提取节点的唯一标识符，用于更精确的去重"""
+    @classmethod
+    @lru_cache(maxsize=100000)
+    def _parse_node(cls, node):
+        """解析节点，一次切分同时得到协议名和唯一标识符（结果按节点缓存，重复节点无需再次解析）"""
+        protocol, sep, data = node.partition('://')
+        if not protocol or not sep:
+            # 作为最后的备选方案，截取部分作为标识
+            return None, node[:200]
+        # 节点正则忽略大小写，协议名统一转为小写，节点字符串本身保持不变
+        protocol = protocol.lower()
+        
+        # 节点内容来自第三方源，单个无法解析的节点不能中断整个合并
         try:
-            # 协议特定的节点标识提取，提高去重精度
-            if node.startswith('vmess://'):
-                data = node.split('://')[1]
-                try:
-                    decoded = base64.b64decode(data + '=' * (4 - len(data) % 4)).decode('utf-8', errors='ignore')
-                    match = self.VMESS_PATTERN.search(decoded)
-                    if match:
-                        return f"vmess:{match.group(1)}:{match.group(2)}"
-                except:
-                    pass
-            elif node.startswith('vless://'):
-                data = node.split('://')[1]
-                match = self.VLESS_PATTERN.search(data)
-                if match:
-                    return f"vless:{match.group(1)}:{match.group(2)}"
-            elif node.startswith('trojan://'):
-                data = node.split('://')[1]
-                match = self.TROJAN_PATTERN.search(data)
-                if match:
-                    return f"trojan:{match.group(1)}:{match.group(2)}"
-            # 对于其他协议，使用简化但仍有效的提取方式
-            # 提取协议和服务器部分作为标识
-            protocol_end = node.find('://')
-            if protocol_end > 0:
-                protocol = node[:protocol_end]
-                server_part = node[protocol_end+3:].split('#')[0].split('?')[0].split('/')[0]
-                return f"{protocol}:{server_part[:100]}"  # 限制长度以平衡性能和精确度
-            
-            # 作为最后的备选方案
-            return node[:200]  # 截取部分作为标识
-        except:
-            return node[:200]  # 发生错误时返回原始节点的前200个字符
+            return protocol, cls._build_node_id(protocol, data)
+        except Exception as e:
+            logging.debug("解析节点标识失败，使用截取的节点作为标识: %s", e)
+            return protocol, node[:200]
     
-    def _filter_invalid_nodes(self, nodes):
-        """过滤无效节点，提高节点质量"""
-        if not nodes:
-            return []
-            
-        valid_nodes = []
-        unique_ids = set()
+    @classmethod
+    def _build_node_id(cls, protocol, data):
+        """根据协议和链接主体构建节点唯一标识"""
+        # 协议特定的节点标识提取，提高去重精度
+        # 常规分支通过显式的匹配结果判断，避免以异常控制流程
+        if protocol == 'vmess':
+            try:
+                # 直接在解码后的字节上匹配，省去UTF-8解码
+                decoded = base64.b64decode(data + cls.BASE64_PADDING[:-len(data) & 3])
+            except (binascii.Error, ValueError):
+                decoded = b''
+            match = cls.VMESS_PATTERN.search(decoded)
+            # 端口为0的节点无效，不作为端点标识
+            if match and int(match.group(2)):
+                return f"vmess:{match.group(1).decode('utf-8', errors='ignore')}:{int(match.group(2))}"
+        elif protocol == 'vless' or protocol == 'trojan':
+            match = cls.HOST_PORT_PATTERN.search(data)
+            if match:
+                # 端口捕获组为1-5位数字，转换为整数后"0443"与"443"视为同一端点
+                port = int(match.group(2))
+                if port:
+                    return f"{protocol}:{match.group(1)}:{port}"
         
-        for node in nodes:
-            # 提取节点唯一标识
-            node_id = self._extract_node_identifier(node)
-            
-            # 检查是否已存在相同标识的节点
-            if node_id not in unique_ids and node_id not in self._node_id_cache:
-                unique_ids.add(node_id)
-                self._node_id_cache.add(node_id)
-                valid_nodes.append(node)
+        # 对于其他协议，使用简化但仍有效的提取方式
+        # 提取协议和服务器部分作为标识
+        server_part = data.partition('#')[0].partition('?')[0].partition('/')[0]
+        return f"{protocol}:{server_part[:100]}"  # 限制长度以平衡性能和精确度
+    
+    def _merge_results(self, results):
+        """流式合并各节点源的结果，按节点标识去重并统计协议分布"""
+        unique_nodes = {}  # 节点标识 -> 节点，保持首次出现的顺序
+        protocol_stats = defaultdict(int)  # 统计各协议节点数量
+        # 循环不变的方法提前绑定到局部变量
+        parse_node = self._parse_node
+        
+        for nodes in results:
+            for node in nodes:
+                # 一次解析得到协议名和节点唯一标识
+                protocol, node_id = parse_node(node)
                 
-                # 统计协议类型
-                protocol_end = node.find('://')
-                if protocol_end > 0:
-                    protocol = node[:protocol_end]
-                    self._protocol_stats[protocol] += 1
+                # 单一字典同时完成去重和保序，每个节点只需一次哈希查找
+                if node_id not in unique_nodes:
+                    unique_nodes[node_id] = node
+                    
+                    # 统计协议类型
+                    if protocol:
+                        protocol_stats[protocol] += 1
+        
+        # 记录协议统计信息
+        if protocol_stats:
+            stats_str = ", ".join([f"{proto}: {count}" for proto, count in protocol_stats.items()])
+            logging.info("节点协议分布: %s", stats_str)
         
-        return valid_nodes
+        return list(unique_nodes.values())
     
     def merge_nodes(self):
         """合并所有节点源"""
@@ -183,7 +293,7 @@ class NodeProcessor:
         # 过滤无效的源URL并去重
         valid_sources = list(dict.fromkeys([url for url in sources if self.URL_PATTERN.match(url)]))
         if len(valid_sources) < len(sources):
-            logging.warning(f"过滤了 {len(sources) - len(valid_sources)} 个无效或重复的源URL")
+            logging.warning("过滤了 %s 个无效或重复的源URL", len(sources) - len(valid_sources))
             sources = valid_sources
         
         source_count = len(sources)
@@ -191,7 +301,7 @@ class NodeProcessor:
             logging.error("没有有效的节点源")
             return []
         
-        logging.info(f"开始合并 {source_count} 个节点源")
+        logging.info("开始合并 %s 个节点源", source_count)
         
         # 根据源的数量动态调整并发数
         adaptive_workers = min(source_count, self.workers)
@@ -199,17 +309,12 @@ class NodeProcessor:
         # 并发获取节点
         try:
             with ThreadPoolExecutor(max_workers=adaptive_workers) as executor:
-                # 使用列表推导式替代extend操作
-                all_nodes = [node for result in executor.map(self.fetch_nodes, sources) for node in result]
+                # 各源结果依次流入去重字典，无需先拼接完整列表
+                all_nodes = self._merge_results(executor.map(self.fetch_nodes, sources))
             
-            # 记录协议统计信息
-            if self._protocol_stats:
-                stats_str = ", ".join([f"{proto}: {count}" for proto, count in self._protocol_stats.items()])
-                logging.info(f"节点协议分布: {stats_str}")
-            
-            logging.info(f"节点合并完成，共获取 {len(all_nodes)} 个唯一有效节点")
+            logging.info("节点合并完成，共获取 %s 个唯一有效节点", len(all_nodes))
         except Exception as e:
-            logging.error(f"合并节点时发生错误: {str(e)}")
+            logging.error("合并节点时发生错误: %s", e)
             # 尝试串行获取作为备选方案
             all_nodes = self._fetch_nodes_serially(sources)
         
@@ -217,46 +322,58 @@ class NodeProcessor:
     
     def _fetch_nodes_serially(self, sources):
         """串行获取节点，作为并发失败的备选方案"""
-        all_nodes = []
-        
         logging.info("尝试串行获取节点源")
-        for url in sources:
-            nodes = self.fetch_nodes(url)
-            all_nodes.extend(nodes)
-            time.sleep(0.5)  # 添加短暂延迟
+        all_nodes = self._merge_results(self._fetch_sources_serially(sources))
         
-        logging.info(f"串行获取完成，共获取 {len(all_nodes)} 个唯一有效节点")
+        logging.info("串行获取完成，共获取 %s 个唯一有效节点", len(all_nodes))
         return all_nodes
     
+    def _fetch_sources_serially(self, sources):
+        """逐个获取节点源，按顺序产出各源的节点列表"""
+        fetch_nodes = self.fetch_nodes  # 绑定方法只创建一次
+        for url in sources:
+            yield fetch_nodes(url)
+            time.sleep(0.5)  # 添加短暂延迟
+    
     def generate_subscription_file(self, nodes, output_file):
-        """生成订阅文件"""
+        """生成订阅文件，成功时返回文件路径"""
         try:
             if not nodes:
-                logging.warning(f"没有节点可生成订阅: {output_file}")
+                logging.warning("没有节点可生成订阅: %s", output_file)
                 return None
             
-            logging.info(f"准备生成订阅文件: {output_file}，包含{len(nodes)}个节点")
-            
-            # 将节点列表转换为字符串并编码
-            nodes_text = '\n'.join(nodes)
-            subscription_content = base64.b64encode(nodes_text.encode('utf-8')).decode('utf-8')
+            logging.info("准备生成订阅文件: %s，包含%s个节点", output_file, len(nodes))
             
-            # 确保目录存在并写入文件
+            # 确保目录存在并以二进制方式写入文件（Base64内容为纯ASCII）
             os.makedirs(os.path.dirname(output_file), exist_ok=True)
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.write(subscription_content)
+            with open(output_file, 'wb') as f:
+                # 边拼接边编码写入，内存中只保留一个分块，无需构造完整的节点文本
+                buffer = bytearray()
+                separator = b''
+                for node in nodes:
+                    buffer += separator
+                    buffer += node.encode('utf-8')
+                    separator = b'\n'
+                    if len(buffer) >= self.WRITE_CHUNK_SIZE:
+                        aligned = len(buffer) - len(buffer) % 3
+                        f.write(base64.b64encode(buffer[:aligned]))
+                        del buffer[:aligned]
+                # 最后一块按需补齐填充
+                f.write(base64.b64encode(buffer))
             
-            # 验证文件是否成功创建
-            if os.path.exists(output_file):
-                file_size = os.path.getsize(output_file)
-                if file_size > 0:
-                    logging.info(f"订阅已生成: {output_file}，大小: {file_size}字节")
-                else:
-                    logging.warning(f"订阅文件为空: {output_file}")
+            # 验证文件是否成功创建，一次stat同时得到存在性和文件大小
+            try:
+                file_size = os.stat(output_file).st_size
+            except FileNotFoundError:
+                logging.error("订阅文件创建失败: %s", output_file)
+                return None
+            
+            if file_size > 0:
+                logging.info("订阅已生成: %s，大小: %s字节", output_file, file_size)
             else:
-                logging.error(f"订阅文件创建失败: {output_file}")
+                logging.warning("订阅文件为空: %s", output_file)
             
-            return subscription_content
+            return output_file
         except Exception as e:
-            logging.error(f"生成订阅文件时发生错误: {str(e)}")
+            logging.error("生成订阅文件时发生错误: %s", e)
             return None
\ No newline at end of file
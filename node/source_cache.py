@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import logging
+import threading
+import time
+
+class SourceCache:
+    """节点源缓存，持久化各源的ETag/Last-Modified及节点列表，用于跨运行的条件请求"""
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version  # 节点提取/解析格式版本，不一致的缓存行视为未缓存
+        self._lock = threading.Lock()  # 多个获取线程共用同一连接
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        
+        # 旧版本的表缺少version列，直接重建
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sources)")}
+        if columns and 'version' not in columns:
+            self._conn.execute("DROP TABLE sources")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sources ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, nodes TEXT, fetched_at REAL, version INTEGER)"
+        )
+
+    def conditional_headers(self, url):
+        """获取节点源的条件请求头，源未缓存时返回空字典"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified FROM sources WHERE url = ? AND version = ?", (url, self.version)
+            ).fetchone()
+
+        headers = {}
+        if row:
+            etag, last_modified = row
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def load_nodes(self, url):
+        """读取节点源上次缓存的节点列表"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT nodes FROM sources WHERE url = ? AND version = ?", (url, self.version)
+            ).fetchone()
+
+        if not row or not row[0]:
+            return []
+        return row[0].split('\n')
+
+    def store(self, url, etag, last_modified, nodes):
+        """缓存节点源的响应标识和节点列表"""
+        # 没有ETag或Last-Modified的源无法发起条件请求，不必缓存
+        if not nodes or not (etag or last_modified):
+            return
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sources (url, etag, last_modified, nodes, fetched_at, version) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, '\n'.join(nodes), time.time(), self.version)
+            )
+        logging.debug("已缓存节点源: %s", url)
+
+    def close(self):
+        """关闭缓存数据库连接"""
+        with self._lock:
+            self._conn.close()